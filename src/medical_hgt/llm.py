@@ -49,6 +49,8 @@ class LLM:
 
         self.tokenizer = tokenizer
         self.tokenizer.pad_token = self.tokenizer.eos_token
+        # Decoder-only models need left padding for batched generation, so that all prompts end at input_encoding_size
+        self.tokenizer.padding_side = 'left'
 
         self.device = self.model.device
 
@@ -78,7 +80,7 @@ class LLM:
         self.input_encoding_size = batch_encoding.input_ids.shape[1]
 
         with torch.no_grad():
-            model_outputs = self.model.generate(batch_encoding.input_ids, attention_mask=batch_encoding.attention_mask, output_scores=True, max_new_tokens=4, return_dict_in_generate=True)
+            model_outputs = self.model.generate(batch_encoding.input_ids, attention_mask=batch_encoding.attention_mask, output_scores=True, max_new_tokens=4, return_dict_in_generate=True, use_cache=True)
 
         # Extract scores per prompt
         scores_per_prompt = [[] for _ in range(batch_size)]
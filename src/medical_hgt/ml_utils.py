@@ -1,6 +1,9 @@
+import os
 import torch
-import heapq
+import datetime
 import time
+
+import torch.distributed as dist
 from torch.optim.lr_scheduler import LRScheduler
 
 import torch.nn.functional as F
@@ -10,52 +13,130 @@ from dataclasses import dataclass
 from src.medical_hgt.llm import LLMFeedback
 
 
-def find_most_relevant_nodes(batch, z_dict, question_nodes_embedding, subgraph_tuples, prime_gk, k=2):
+def group_subgraph_tuples(subgraph_tuples, device='cpu'):
+    """
+
+    Args:
+        subgraph_tuples: a list of tuples (node_uid, node_type) from the question's heterogeneous graph
+        device: the device on which the node uid tensors are stored
+
+    Returns:
+        subgraph_uids_dict: a mapping from node types to a LongTensor of the node uids of that type ({node_type: tensor, node_type: tensor...})
+
+    """
+    grouped_uids = {}
+    for node_uid, node_type in subgraph_tuples:
+        grouped_uids.setdefault(node_type, []).append(node_uid)
+
+    return {node_type: torch.tensor(node_uids, dtype=torch.long, device=device) for node_type, node_uids in grouped_uids.items()}
+
+
+def build_llm_feedbacks_tensor(llm_feedbacks_dict, num_questions, device='cpu'):
     """
 
+    Args:
+        llm_feedbacks_dict: a mapping from questions in the MedMCQA dataset to the pre-computed LLM Feedback
+        num_questions: the number of questions in the MedMCQA dataset, so that every question uid is a valid index
+        device: the device on which the tensor is stored
+
+    Returns:
+        llm_feedbacks_tensor: a dense [num_questions, 2] tensor indexed by question uid, holding the LLM's confidence in the correct answer
+            and whether it answered correctly, both without context (nan for questions without feedback).
+            Stored as float64, so that question uids and confidences survive concatenation with it unchanged
+
+    """
+    question_uids = torch.tensor(list(llm_feedbacks_dict.keys()), dtype=torch.long)
+    feedbacks = torch.tensor([[llm_feedback.cop_confidence_without_context, float(llm_feedback.is_correct_without_context)] for llm_feedback in llm_feedbacks_dict.values()], dtype=torch.float64)
+
+    llm_feedbacks_tensor = torch.full((max(num_questions, max(llm_feedbacks_dict, default=-1) + 1), 2), float('nan'), dtype=torch.float64)
+    if len(llm_feedbacks_dict) > 0:
+        llm_feedbacks_tensor[question_uids] = feedbacks
+
+    return llm_feedbacks_tensor.to(device)
+
+
+def find_most_relevant_nodes(batch, z_dict, questions_embeddings, subgraph_uids_dicts, prime_gk, k=2):
+    """
+    Finds the most relevant nodes for a number of questions at once: the candidates of all questions are matched, scored and ranked together
+
     Args:
         batch: a batch of HeteroData from the training dataset of MedGraphTrans
         z_dict: the node representations after an HGT forward pass. ({node_type: tensor, node_type: tenser...})
-        question_nodes_embedding: The representation of the question node
-        subgraph_tuples: a list of tuples (node_uid, node_type) from the question's heterogeneous graph
+        questions_embeddings: the representations of the question nodes, a [num_questions, channels] tensor
+        subgraph_uids_dicts: per question, its heterogeneous graph nodes grouped by type, as returned by group_subgraph_tuples
         prime_gk: the knowledge graph used for knowledge extraction
-        k: number of relevant nodes to return
+        k: number of relevant nodes to return per question
 
     Returns:
-        relevant_nodes_list: the list of all relevant nodes
+        relevant_nodes_lists: per question, the list of all relevant nodes
 
     """
-    # Using a heap for efficient minimum distance tracking
-    relevant_nodes_heap = []
-    heapq.heapify(relevant_nodes_heap)
+    num_questions = questions_embeddings.size(0)
 
-    for node_uid, node_type in subgraph_tuples:
+    candidate_embeddings = []
+    candidate_uids = []
+    candidate_owners = []  # the position of the question each candidate belongs to
+
+    for node_type in dict.fromkeys(node_type for subgraph_uids_dict in subgraph_uids_dicts for node_type in subgraph_uids_dict):
 
         if len(batch[node_type]) == 0:
             continue
-        node_index = torch.where(batch[node_type].node_uid == node_uid)[0][0]
-        node_embeddings = z_dict[node_type][node_index]
-
-        # Calculate distance
-        distance = torch.norm(question_nodes_embedding - node_embeddings, p=2)
-
-        # Get node information
-        node_info = prime_gk.nodes[node_uid]
-        node_info_string = f"The {node_info['type']} {node_info['name']}"
-
-        # Update the relevant nodes list and distances
-        if len(relevant_nodes_heap) < k:
-            heapq.heappush(relevant_nodes_heap, (distance, node_info_string))
-        else:
-            # Only update if the current distance is greater than the smallest in the heap
-            if distance > relevant_nodes_heap[0][0]:
-                heapq.heappop(relevant_nodes_heap)
-                heapq.heappush(relevant_nodes_heap, (distance, node_info_string))
 
-    # Convert heap to a list of relevant nodes, sorting by distance
-    relevant_nodes_list = [node for _, node in sorted(relevant_nodes_heap, reverse=True)]
+        # Flatten the nodes of this type of all questions (CSR like), remembering which question they came from
+        questions_node_uids = [(question_position, subgraph_uids_dict[node_type]) for question_position, subgraph_uids_dict in enumerate(subgraph_uids_dicts) if node_type in subgraph_uids_dict]
+        node_uids = torch.cat([node_uids for _, node_uids in questions_node_uids])
+        owners = torch.cat([torch.full_like(node_uids, question_position) for question_position, node_uids in questions_node_uids])
+
+        # Match them against the batch at once
+        matches = node_uids.unsqueeze(1) == batch[node_type].node_uid.unsqueeze(0)
+        found = matches.any(dim=1)
+        node_indices = matches.int().argmax(dim=1)[found]
+
+        candidate_embeddings.append(z_dict[node_type][node_indices])
+        candidate_uids.append(node_uids[found])
+        candidate_owners.append(owners[found])
+
+    if len(candidate_embeddings) == 0:
+        return [[] for _ in range(num_questions)]
+
+    candidate_embeddings = torch.cat(candidate_embeddings, dim=0)
+    candidate_uids = torch.cat(candidate_uids, dim=0)
+    candidate_owners = torch.cat(candidate_owners, dim=0)
+
+    # Calculate the distances of all candidates to their question in one pass
+    distances = torch.norm(candidate_embeddings - questions_embeddings[candidate_owners], p=2, dim=-1)
+
+    # Scatter the distances into a [num_questions, max_num_candidates] matrix, padded with -inf (distances are never negative)
+    order = torch.argsort(candidate_owners, stable=True)
+    candidate_owners, candidate_uids, distances = candidate_owners[order], candidate_uids[order], distances[order]
+
+    num_candidates = torch.bincount(candidate_owners, minlength=num_questions)
+    offsets = torch.cumsum(num_candidates, dim=0) - num_candidates
+    positions = torch.arange(candidate_owners.size(0), device=candidate_owners.device) - offsets[candidate_owners]
+    max_num_candidates = int(num_candidates.max())
+
+    scores = torch.full((num_questions, max_num_candidates), float('-inf'), dtype=distances.dtype, device=distances.device)
+    scores[candidate_owners, positions] = distances
+    uids_matrix = torch.full((num_questions, max_num_candidates), -1, dtype=torch.long, device=candidate_uids.device)
+    uids_matrix[candidate_owners, positions] = candidate_uids
+
+    # Keep the k nodes with the greatest distance per question, sorted by distance
+    top_scores, top_indices = torch.topk(scores, min(k, max_num_candidates), dim=1)
+    top_uids = uids_matrix.gather(1, top_indices).tolist()
+    is_candidate = torch.isfinite(top_scores).tolist()
+
+    # Get node information
+    relevant_nodes_lists = []
+    for question_top_uids, question_is_candidate in zip(top_uids, is_candidate):
+        relevant_nodes_list = []
+        for node_uid, node_is_candidate in zip(question_top_uids, question_is_candidate):
+            if not node_is_candidate:
+                continue
+            node_info = prime_gk.nodes[node_uid]
+            relevant_nodes_list.append(f"The {node_info['type']} {node_info['name']}")
+        relevant_nodes_lists.append(relevant_nodes_list)
 
-    return relevant_nodes_list
+    return relevant_nodes_lists
 
 
 @dataclass(frozen=True)
@@ -124,31 +205,79 @@ class ModelResult:
         return self.get_total_train_time_sec() // 60
 
 
+def init_distributed(timeout_hours=6):
+    """
+    Initializes the default NCCL process group if the script was launched with torchrun (WORLD_SIZE > 1)
+
+    Args:
+        timeout_hours: how long the processes wait on each other in a collective. The other ranks wait while rank 0 runs the
+            LLM-aided validation (and test) evaluation, which takes far longer than the NCCL default
+
+    Returns:
+        is_distributed: whether training runs on multiple processes
+        rank: the global rank of the current process
+        local_rank: the rank of the current process on its node, used as its GPU index
+
+    """
+    if not dist.is_available() or int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return False, 0, 0
+
+    if not dist.is_initialized():
+        dist.init_process_group('nccl', timeout=datetime.timedelta(hours=timeout_hours))
+
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    torch.cuda.set_device(local_rank)
+
+    return True, dist.get_rank(), local_rank
+
+
+def broadcast_from_main_process(obj):
+    """Sends a picklable object from rank 0 to all processes and returns it."""
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+def has_uninitialized_parameters(module):
+    """Returns True if the module still holds lazy parameters (e.g. Linear(-1, channels)) which are only materialized in the first forward pass."""
+    return any(isinstance(param, torch.nn.parameter.UninitializedParameter) for param in module.parameters())
+
+
+def pin_batches(split_loaders, split_names=None):
+    """
+    Moves the tensors of the batches to page-locked memory, allowing asynchronous host to device transfers.
+    The HeteroData batches are modified in place.
+
+    Args:
+        split_loaders: a dict {train: train_batches_list, val: val_batches_list, test: test_batches_list}
+        split_names: the splits to pin, all of them if None
+
+    """
+    for split_name, batches in split_loaders.items():
+        if split_names is None or split_name in split_names:
+            for batch in batches:
+                batch.pin_memory()
+
+
 def get_time():
     """Returns the current Unix (epoch) timestamp, in seconds."""
     return round(time.time())
 
 
-def compute_link_prediction_loss(pos_preds: torch.Tensor, neg_preds: torch.Tensor, pos_labels: torch.Tensor, neg_labels: torch.Tensor, device) -> torch.Tensor:
+def compute_link_prediction_loss(preds: torch.Tensor, labels: torch.Tensor, device) -> torch.Tensor:
     """
     Args:
-    pos_preds (torch.Tensor): Predictions for positive links, expected to be logits.
-    neg_preds (torch.Tensor): Predictions for negative links, expected to be logits.
-    pos_labels (torch.Tensor): Ground truth labels for positive links.
-    neg_labels (torch.Tensor): Ground truth labels for negative links.
+    preds (torch.Tensor): Predictions for the positive links followed by the negative links, expected to be logits.
+    labels (torch.Tensor): Ground truth labels for preds.
 
     Returns:
     torch.Tensor: The combined binary cross-entropy loss for positive and negative predictions.
     """
 
     # Assign weights
-    pos_weight = torch.tensor([2.0])  # As we have 2 times more negative samples
-    neg_weight = torch.tensor([1.0])
+    pos_weight = torch.tensor([2.0], device=device)  # As we have 2 times more negative samples
 
-    preds_tensor = torch.cat((pos_preds, neg_preds), dim=0)
-    trues_tensor = torch.cat((pos_labels, neg_labels), dim=0)
-
-    total_loss = F.binary_cross_entropy_with_logits(preds_tensor.to(device), trues_tensor.to(device), pos_weight=pos_weight.to(device))
+    total_loss = F.binary_cross_entropy_with_logits(preds.to(device), labels.to(device), pos_weight=pos_weight)
 
     return total_loss
 
@@ -199,6 +328,75 @@ def compute_llm_relevancy_loss(batch, z_dict, llm_feedback_dict: LLMFeedback):
     return loss / max(num_nodes, 1)
 
 
+class RunningMean:
+    """Keeps the sum and count of the accumulated values instead of storing them."""
+
+    def __init__(self):
+        self.total = 0.0
+        self.count = 0
+
+    def update(self, value):
+        self.total += value
+        self.count += 1
+
+    def mean(self):
+        return self.total / max(1, self.count)
+
+
+class BatchPrefetcher:
+    """
+    Iterates over a list of mini-batches, copying the next batch to the device on a side CUDA stream while the current one is processed.
+    On other devices the batches are simply moved to the device one by one.
+    """
+
+    def __init__(self, batches, device):
+        self.batches = batches
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        batches_iterator = iter(self.batches)
+        next_batch, next_event = self.preload(batches_iterator)
+
+        while next_batch is not None:
+            batch, event = next_batch, next_event
+
+            if event is not None:
+                # Wait only for the copy of this batch, then tie its memory to the compute stream
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_event(event)
+                batch.apply(lambda tensor: record_stream(tensor, current_stream))
+
+            # Start copying the following batch before the current one is processed
+            next_batch, next_event = self.preload(batches_iterator)
+
+            yield batch
+
+    def preload(self, batches_iterator):
+        batch = next(batches_iterator, None)
+
+        if batch is None:
+            return None, None
+
+        if self.stream is None:
+            return batch.to(self.device), None
+
+        with torch.cuda.stream(self.stream):
+            batch = batch.to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+
+        return batch, event
+
+
+def record_stream(tensor, stream):
+    tensor.record_stream(stream)
+    return tensor
+
+
 class LinearDecayLR(LRScheduler):
     def __init__(self, optimizer, decay_rate=0.00005, min_lr=0.00001, last_epoch=-1):
         self.decay_rate = decay_rate
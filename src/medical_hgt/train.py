@@ -1,14 +1,24 @@
-import copy
+import os
+import math
+
+# Expandable segments keep the caching allocator from fragmenting on mini-batches of varying sizes.
+# Only read on the first CUDA allocation, so setting it here is early enough even if torch is already imported.
+os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True,max_split_size_mb:128,garbage_collection_threshold:0.8')
+
 import torch
 
+import torch.distributed as dist
+
 import pandas as pd
-import numpy as np
 
 from tqdm import tqdm
-from sklearn.metrics import roc_auc_score
-from torchmetrics.classification import BinaryPrecision
+from torchmetrics.classification import BinaryAUROC, BinaryPrecision
+from torchmetrics.functional.classification import binary_auroc
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
 
-from src.medical_hgt.ml_utils import find_most_relevant_nodes, EpochResult, ModelResult, get_time, compute_llm_relevancy_loss, compute_link_prediction_loss, LinearDecayLR
+from src.utils import answer_letters
+from src.medical_hgt.ml_utils import find_most_relevant_nodes, group_subgraph_tuples, build_llm_feedbacks_tensor, EpochResult, ModelResult, get_time, RunningMean, init_distributed, broadcast_from_main_process, has_uninitialized_parameters, pin_batches, BatchPrefetcher, compute_llm_relevancy_loss, compute_link_prediction_loss, LinearDecayLR
 
 
 def train(llm,
@@ -23,14 +33,16 @@ def train(llm,
           question_to_subgraphs_mapping,
           num_epochs=30,
           lr=0.001,
-          link_prediction_loss_weight=0.3):
+          link_prediction_loss_weight=0.3,
+          mixed_precision=True,
+          compile_model=True):
     """
 
     Args:
         llm: a loaded LLM
         medical_hgt: an initialized MedicalHGT
         split_loaders: a dict {train: train_batches_list, val: val_batches_list, test: test_batches_list}
-        device: 'cude' if available, else 'cpu'
+        device: 'cude' if available, else 'cpu'. Ignored when launched with torchrun, each process then uses the GPU of its local rank
         file_name: used for saving the model during anf after training
         qa_dataset: the loaded MedMCQA dataset
         prime_kg: nx graph object a subset of PrimKG
@@ -41,27 +53,90 @@ def train(llm,
         num_epochs: upper bound for the number of epochs
         lr: learning rate
         link_prediction_loss_weight: the weight of the link prediction performance to the performance of the model
+        mixed_precision: run the training forward pass under bfloat16 autocast (only on GPUs supporting bfloat16)
+        compile_model: compile the HGT with torch.compile for training and evaluation
 
     Returns:
-        medical_hgt_result: a ModelResult object
+        medical_hgt_result: a ModelResult object (None on all processes but rank 0 when training distributed)
 
     """
 
+    # When launched with torchrun the train batches are sharded across the processes (one per GPU) and gradients are all-reduced by DDP.
+    # Evaluation with the LLM only runs on rank 0 and its results are broadcast to the other processes.
+    is_distributed, rank, local_rank = init_distributed()
+    is_main_process = rank == 0
+
+    if is_distributed:
+        device = torch.device('cuda', local_rank)
+
     medical_hgt = medical_hgt.to(device)
 
+    use_autocast = False
+    if torch.device(device).type == 'cuda':
+        # TF32 matmuls and cudnn autotuning for the HGT attention
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+
+        # bfloat16 has the range of float32, so no GradScaler is needed
+        use_autocast = mixed_precision and torch.cuda.is_bf16_supported()
+
+    # Page-locked batches let batch.to(device, non_blocking=True) overlap the copies with compute
+    # Only rank 0 evaluates, so the other processes only need the train batches pinned
+    if torch.device(device).type == 'cuda':
+        pin_batches(split_loaders, split_names=None if is_main_process else ['train'])
+
+    train_loader = split_loaders['train']
+
+    # DDP can only register materialized parameters and torch.compile should not trace their initialization, so run the lazy
+    # layers once before wrapping the model (in eval mode to leave the batch norm statistics untouched)
+    medical_hgt.eval()
+    with torch.no_grad():
+        for batch in train_loader:
+            if not has_uninitialized_parameters(medical_hgt):
+                break
+            medical_hgt(batch.to(device))
+
+    if is_distributed:
+        # Not all node types, edge types or the batch normalization take part in every batch
+        medical_hgt = DistributedDataParallel(medical_hgt, device_ids=[local_rank], find_unused_parameters=True)
+        train_loader = [train_loader[i] for i in DistributedSampler(train_loader, shuffle=False)]
+
+    # The underlying MedicalHGT, used for evaluation and saving
+    hgt_module = medical_hgt.module if is_distributed else medical_hgt
+    eval_medical_hgt = hgt_module
+
+    if compile_model:
+        # Shapes are dynamic since the mini-batches vary in their number of nodes and edges. The default mode is used rather than
+        # 'reduce-overhead', whose CUDA graphs reuse output buffers, while predictions are kept across batches for the metrics.
+        medical_hgt = torch.compile(medical_hgt, dynamic=True)
+        eval_medical_hgt = torch.compile(hgt_module, dynamic=True)
+
     medical_hgt.train()
 
-    opt = torch.optim.Adam(medical_hgt.parameters(), lr=lr)
+    # The fused implementation updates all parameters in a single kernel (CUDA only)
+    opt = torch.optim.Adam(medical_hgt.parameters(), lr=lr, fused=torch.device(device).type == 'cuda')
     scheduler = LinearDecayLR(opt)
 
     precision = BinaryPrecision()
 
+    # Train metrics are updated batch by batch on the device, avoiding a host sync of all epoch predictions
+    train_auroc_metric = BinaryAUROC().to(device)
+    train_precision_metric = BinaryPrecision().to(device)
+
     eval_qa_dataset = pd.DataFrame(qa_dataset['validation'])
+    # Row lookups are done once here, so evaluate only needs O(1) dict access per question
+    eval_qa_records = eval_qa_dataset[['question', 'opa', 'opb', 'opc', 'opd', 'cop']].to_dict(orient='index')
 
-    start_time = get_time()
-    print(f'Saving results to {file_name}')
+    # question_to_subgraphs_mapping is immutable, so the grouped subgraph node uids are shared by all evaluate calls
+    subgraph_uids_cache = {}
 
-    train_loader = split_loaders['train']
+    # The LLM's feedbacks without context, used to decide which questions get a context during evaluation
+    val_llm_feedbacks_tensor = build_llm_feedbacks_tensor(val_llm_feedbacks_dict, num_questions=len(eval_qa_records), device=device)
+
+    start_time = get_time()
+    if is_main_process:
+        print(f'Saving results to {file_name}')
 
     llm_relevancy_loss_weight = 1 - link_prediction_loss_weight
 
@@ -71,119 +146,133 @@ def train(llm,
         train_start_time = get_time()
 
         train_losses = []
-        pos_y_pred_tensors = []
-        neg_y_pred_tensors = []
-        pos_y_true_tensors = []
-        neg_y_true_tensors = []
 
-        print("Train Batches...")
-        for batch in tqdm(train_loader):
-            batch = batch.to(device)
+        if is_main_process:
+            print("Train Batches...")
+        for batch in tqdm(BatchPrefetcher(train_loader, device), disable=not is_main_process):
 
-            opt.zero_grad()
+            opt.zero_grad(set_to_none=True)
 
-            # HGT forward pass
-            pos_train_pred, neg_train_pred, z_dict = medical_hgt(batch)
+            with torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=use_autocast):
+                # HGT forward pass
+                pos_train_pred, neg_train_pred, z_dict = medical_hgt(batch)
 
-            pos_train_y = batch["question", "question_correct_answer", "answer"].edge_label.squeeze()
-            if pos_train_y.dim() == 0:
-                pos_train_y = pos_train_y.view(1)
+                pos_train_y = batch["question", "question_correct_answer", "answer"].edge_label.squeeze()
+                if pos_train_y.dim() == 0:
+                    pos_train_y = pos_train_y.view(1)
 
-            # Dynamically sample negative examples
-            neg_indices = batch["question", "question_wrong_answer", "answer"].edge_label_index
-            neg_labels = batch["question", "question_wrong_answer", "answer"].edge_label.squeeze()
+                # Dynamically sample negative examples
+                neg_indices = batch["question", "question_wrong_answer", "answer"].edge_label_index
+                neg_labels = batch["question", "question_wrong_answer", "answer"].edge_label.squeeze()
 
-            # Randomly sample a subset of negative examples
-            num_neg_samples = 2 # or // 3,
-            neg_sample_indices = torch.randperm(neg_indices.size(1))[:num_neg_samples * pos_train_y.size(0)]
+                # Randomly sample a subset of negative examples (directly on the device)
+                num_neg_samples = 2 # or // 3,
+                neg_sample_indices = torch.randperm(neg_indices.size(1), device=neg_train_pred.device)[:num_neg_samples * pos_train_y.size(0)]
+
+                neg_train_pred = neg_train_pred[neg_sample_indices]
+                neg_train_y = neg_labels[neg_sample_indices]
 
-            neg_train_pred = neg_train_pred[neg_sample_indices]
-            neg_train_y = neg_labels[neg_sample_indices]
+                if neg_train_y.dim() == 0:
+                    neg_train_y = neg_train_y.view(1)
 
-            if neg_train_y.dim() == 0:
-                neg_train_y = neg_train_y.view(1)
+                # Positive and negative links are concatenated once, for both the loss and the metrics
+                train_pred = torch.cat([pos_train_pred, neg_train_pred])
+                train_y = torch.cat([pos_train_y, neg_train_y])
 
-            link_prediction_loss = compute_link_prediction_loss(pos_train_pred, neg_train_pred, pos_train_y, neg_train_y, device=device)
+                link_prediction_loss = compute_link_prediction_loss(train_pred, train_y, device=device)
 
-            llm_relevancy_loss = compute_llm_relevancy_loss(batch, z_dict, train_llm_feedbacks_dict)
+                llm_relevancy_loss = compute_llm_relevancy_loss(batch, z_dict, train_llm_feedbacks_dict)
 
-            # Weighted dual-task loss
-            total_loss = link_prediction_loss_weight * link_prediction_loss + llm_relevancy_loss_weight * llm_relevancy_loss
+                # Weighted dual-task loss
+                total_loss = link_prediction_loss_weight * link_prediction_loss + llm_relevancy_loss_weight * llm_relevancy_loss
 
             # Backward pass
             total_loss.backward()
             opt.step()
 
             # Store results
-            pos_y_pred_tensors.append(pos_train_pred.detach())
-            neg_y_pred_tensors.append(neg_train_pred.detach())
-            pos_y_true_tensors.append(pos_train_y.detach().long())
-            neg_y_true_tensors.append(neg_train_y.detach().long())
+            # Pass probabilities, torchmetrics only applies a sigmoid to batches with values outside [0, 1]
+            batch_train_pred = train_pred.detach().float().sigmoid()
+            batch_train_true = train_y.detach().long()
+            train_auroc_metric.update(batch_train_pred, batch_train_true)
+            train_precision_metric.update(batch_train_pred, batch_train_true)
 
-            train_losses.append(total_loss.detach().item())
+            # Keep the loss on the device, it is only synced once per epoch
+            train_losses.append(total_loss.detach().float())
 
         train_end_time = get_time()
 
-        # Accumulate train results
-        pos_pred = torch.cat(pos_y_pred_tensors, dim=0).cpu().numpy()
-        neg_pred = torch.cat(neg_y_pred_tensors, dim=0).cpu().numpy()
-        pos_true = torch.cat(pos_y_true_tensors, dim=0).cpu().numpy()
-        neg_true = torch.cat(neg_y_true_tensors, dim=0).cpu().numpy()
-
-        pred = np.concatenate([pos_pred, neg_pred])
-        true = np.concatenate([pos_true, neg_true])
+        mean_train_loss = torch.stack(train_losses).mean()
+        if is_distributed:
+            dist.all_reduce(mean_train_loss, op=dist.ReduceOp.AVG)
+        mean_train_loss = round(mean_train_loss.item(), 4)
 
         # the training ROC AUC is computed using all the predictions (and ground
         # truth labels) made during the entire epoch, across all batches. Note that
         # this is arguably a bit inconsistent with validation below since it doesn't
         # give the medical_hgt a "second try" for earlier batches, for which it couldn't
         # have yet applied anything it learned in later batches.
-        train_roc_auc = roc_auc_score(true, pred)
-        train_precision = precision(torch.tensor(pred), torch.tensor(true))
-
-        # The validation ROC AUC is computed by running through the validation set
-        # at the end of every epoch.
-        val_pred, val_true, val_llm_acc_dict = evaluate(llm, medical_hgt, split_loaders, 'val', device, eval_qa_dataset, prime_kg, val_llm_feedbacks_dict, question_to_subgraphs_mapping)
-
-        val_roc_auc = roc_auc_score(val_true, val_pred)
-        val_precision = precision(torch.tensor(val_pred), torch.tensor(val_true))
-
-        epoch_result = EpochResult(
-            epoch_num=epoch_num,
-            train_start_time=train_start_time,
-            train_end_time=train_end_time,
-            mean_train_loss=round(np.mean(train_losses), 4),
-            train_roc_aoc=train_roc_auc,
-            train_precision=train_precision,
-            val_roc_aoc=val_roc_auc,
-            val_precision=val_precision,
-            llm_results = val_llm_acc_dict
-        )
+        # (torchmetrics synchronizes the metric states of all processes on compute)
+        train_roc_auc = train_auroc_metric.compute().item()
+        train_precision = train_precision_metric.compute().item()
+        train_auroc_metric.reset()
+        train_precision_metric.reset()
+
+        epoch_result = None
+        if is_main_process:
+            # The validation ROC AUC is computed by running through the validation set
+            # at the end of every epoch.
+            val_pred, val_true, val_llm_acc_dict = evaluate(llm, eval_medical_hgt, split_loaders, 'val', device, eval_qa_records, prime_kg, val_llm_feedbacks_dict, question_to_subgraphs_mapping, subgraph_uids_cache=subgraph_uids_cache, llm_feedbacks_tensor=val_llm_feedbacks_tensor)
+
+            val_roc_auc = binary_auroc(val_pred, val_true).item()
+            val_precision = precision(val_pred, val_true)
+
+            epoch_result = EpochResult(
+                epoch_num=epoch_num,
+                train_start_time=train_start_time,
+                train_end_time=train_end_time,
+                mean_train_loss=mean_train_loss,
+                train_roc_aoc=train_roc_auc,
+                train_precision=train_precision,
+                val_roc_aoc=val_roc_auc,
+                val_precision=val_precision,
+                llm_results = val_llm_acc_dict
+            )
+
+        if is_distributed:
+            epoch_result = broadcast_from_main_process(epoch_result)
 
         # Output the number of model params:
-        if epoch_num == 1:
+        if epoch_num == 1 and is_main_process:
             # Total number of parameters
-            total_params = sum(p.numel() for p in medical_hgt.parameters())
+            total_params = sum(p.numel() for p in hgt_module.parameters())
 
             # Number of trainable parameters
-            trainable_params = sum(p.numel() for p in medical_hgt.parameters() if p.requires_grad)
+            trainable_params = sum(p.numel() for p in hgt_module.parameters() if p.requires_grad)
 
             print(f"Total Parameters: {total_params}")
             print(f"Trainable Parameters: {trainable_params}")
 
         epoch_results.append(epoch_result)
-        print(f'\r{epoch_result}')
+        if is_main_process:
+            print(f'\r{epoch_result}')
 
         scheduler.step()
 
-    state_dict = copy.deepcopy(medical_hgt.state_dict())
+    if not is_main_process:
+        # Wait for rank 0 to finish the test evaluation
+        dist.barrier()
+        return None
+
+    # Copy the weights straight to the host, without the pickling round trip of copy.deepcopy
+    state_dict = {key: value.detach().to('cpu', copy=True) for key, value in hgt_module.state_dict().items()}
 
     # Run through the test set
-    test_pred, test_true, test_llm_acc_dict = evaluate(llm, medical_hgt, split_loaders, 'test', device, eval_qa_dataset, prime_kg, val_llm_feedbacks_dict, question_to_subgraphs_mapping)
+    test_pred, test_true, test_llm_acc_dict = evaluate(llm, eval_medical_hgt, split_loaders, 'test', device, eval_qa_records, prime_kg, val_llm_feedbacks_dict, question_to_subgraphs_mapping, subgraph_uids_cache=subgraph_uids_cache, llm_feedbacks_tensor=val_llm_feedbacks_tensor)
 
-    test_roc_auc = roc_auc_score(test_true, test_pred)
-    test_precision = precision(torch.tensor(test_pred), torch.tensor(test_true))
-    medical_hgt.eval()
+    test_roc_auc = binary_auroc(test_pred, test_true).item()
+    test_precision = precision(test_pred, test_true)
+    hgt_module.eval()
 
     end_time = get_time()
 
@@ -193,10 +282,13 @@ def train(llm,
     train_time_min = medical_hgt_result.get_total_train_time_min()
     print(f'\rTest Accuracy: {test_roc_auc:.3f}; LLM Results: {test_llm_acc_dict}, Total Train Time: {train_time_min} min')
 
+    if is_distributed:
+        dist.barrier()
+
     return medical_hgt_result
 
 
-def evaluate(llm, medical_hgt, split_loaders, split_name, device, qa_dataset, prime_kg, llm_feedbacks_dict, question_to_subgraphs_mapping, frac=1.0):
+def evaluate(llm, medical_hgt, split_loaders, split_name, device, qa_records, prime_kg, llm_feedbacks_dict, question_to_subgraphs_mapping, frac=1.0, subgraph_uids_cache=None, llm_feedbacks_tensor=None):
     """
 
     Args:
@@ -205,40 +297,46 @@ def evaluate(llm, medical_hgt, split_loaders, split_name, device, qa_dataset, pr
         split_loaders: a dict {train: train_batches_list, val: val_batches_list, test: test_batches_list}
         split_name: 'val' or 'test'
         device: 'cude' if available, else 'cpu'
-        qa_dataset: the loaded MedMCQA dataset
+        qa_records: a mapping from question uids to their MedMCQA rows ({question_uid: {'question': ..., 'opa': ..., 'opb': ..., 'opc': ..., 'opd': ..., 'cop': ...}})
         prime_kg: nx graph object a subset of PrimKG
         llm_feedbacks_dict: a mapping from questions in the MedMCQA dataset to the pre-computed LLM Feedback, answering the questions with and without context
         question_to_subgraphs_mapping: a mapping from questions in the MedMCQA dataset to their corresponding heterogeneous graphs' nodes (in for of tuples (node_type, node_uid)
         frac: a fraction of the batches to process
+        subgraph_uids_cache: an optional dict caching the output of group_subgraph_tuples per question uid across calls
+        llm_feedbacks_tensor: the output of build_llm_feedbacks_tensor for llm_feedbacks_dict, built here if not given
 
     Returns:
-        pred: link prediction results
-        true: link prediction ground truths
+        pred: link prediction results (a cpu tensor of logits)
+        true: link prediction ground truths (a cpu long tensor)
         llm_results: llm vanilla and context accuracies (dict)
 
     """
 
     medical_hgt.eval()
 
+    if subgraph_uids_cache is None:
+        subgraph_uids_cache = {}
+
+    if llm_feedbacks_tensor is None:
+        llm_feedbacks_tensor = build_llm_feedbacks_tensor(llm_feedbacks_dict, num_questions=len(qa_records), device=device)
+
     pos_y_true_tensors = []
     neg_y_true_tensors = []
     pos_y_pred_tensors = []
     neg_y_pred_tensors = []
-    average_llm_aided_confidence_list = []
-    average_llm_aided_accuracy_list = []
-    average_llm_vanilla_confidence_list = []
-    average_llm_vanilla_accuracy_list = []
+    average_llm_aided_confidence = RunningMean()
+    average_llm_aided_accuracy = RunningMean()
+    average_llm_vanilla_confidence = RunningMean()
+    average_llm_vanilla_accuracy = RunningMean()
 
     loader = split_loaders[split_name]
 
     num_batches = round(frac * len(loader))
 
     print('Validation Batches...')
-    for i, batch in enumerate(tqdm(loader)):
+    for i, batch in enumerate(tqdm(BatchPrefetcher(loader, device))):
         batch_num = i + 1
 
-        batch = batch.to(device)
-
         with torch.no_grad():
 
             # Forward pass
@@ -253,9 +351,9 @@ def evaluate(llm, medical_hgt, split_loaders, split_name, device, qa_dataset, pr
             neg_indices = batch["question", "question_wrong_answer", "answer"].edge_label_index
             neg_labels = batch["question", "question_wrong_answer", "answer"].edge_label.squeeze()
 
-            # Randomly sample a subset of negative examples
+            # Randomly sample a subset of negative examples (directly on the device)
             num_neg_samples = 2 # or // 3,
-            neg_sample_indices = torch.randperm(neg_indices.size(1))[:num_neg_samples * pos_eval_y.size(0)]
+            neg_sample_indices = torch.randperm(neg_indices.size(1), device=neg_pred.device)[:num_neg_samples * pos_eval_y.size(0)]
 
             neg_pred = neg_pred[neg_sample_indices]
             neg_eval_y = neg_labels[neg_sample_indices]
@@ -269,29 +367,54 @@ def evaluate(llm, medical_hgt, split_loaders, split_name, device, qa_dataset, pr
             neg_y_true_tensors.append(neg_eval_y.detach())
 
             # Retrieve the HGT's nodes representations and use them to create context for the validation questions
-            correct_answer_map = {0: 'A', 1: 'B', 2: 'C', 3: 'D'}
-            answer_letter_to_op_map = {'A': 'opa', 'B': 'opb', 'C': 'opc', 'D': 'opd'}
-
-            vanilla_accuracy_list, vanilla_confidence_list, llm_aided_accuracy_list, llm_aided_confidence_list = [], [], [], []
+            vanilla_accuracy, vanilla_confidence, llm_aided_accuracy, llm_aided_confidence = RunningMean(), RunningMean(), RunningMean(), RunningMean()
+            questions_needing_context = []  # (position in unseen_questions_indices, question_uid, cop_confidence_without_context, is_correct_without_context)
+            questions_with_context = []  # (question_uid, correct_answer, prompt, cop_confidence_without_context, is_correct_without_context)
             unseen_questions_indices = batch["question", "question_correct_answer", "answer"].edge_label_index[0]
             if unseen_questions_indices.dim() == 0:
                 unseen_questions_indices = unseen_questions_indices.unsqueeze(-1)
 
-            for question_index in unseen_questions_indices:
+            # Look up the LLM's feedbacks for all questions of the batch with one gather and copy them to the host together with the uids
+            unseen_questions_uids = batch['question'].node_uid[unseen_questions_indices]
+            unseen_questions_feedbacks = torch.cat([unseen_questions_uids.unsqueeze(1).double(), llm_feedbacks_tensor[unseen_questions_uids]], dim=1).tolist()
 
-                question_node_representation = torch.index_select(z_dict['question'], 0, question_index)  # z_dict['question'][question_index]
+            # Gather the representations of all the batch's questions with a single index_select
+            unseen_questions_embeddings = z_dict['question'].index_select(0, unseen_questions_indices)
 
-                question_uid = batch['question'].node_uid[question_index].item()
-                if question_uid not in llm_feedbacks_dict:
+            for j, (question_uid, cop_confidence_without_context, is_correct_without_context) in enumerate(unseen_questions_feedbacks):
+
+                # nan marks questions without feedback
+                if math.isnan(cop_confidence_without_context):
                     continue
 
-                llm_feedback_without_context = llm_feedbacks_dict[question_uid]
-                if llm_feedback_without_context.cop_confidence_without_context < 0.26:
-                    subgraph_tuples = question_to_subgraphs_mapping[question_uid]
-                    most_relevant_nodes = find_most_relevant_nodes(batch, z_dict, question_node_representation, subgraph_tuples, prime_kg, k=2)
-                    dataset_row = qa_dataset.iloc[question_uid]
-                    question_dict = dict(dataset_row.drop(['id', 'cop', 'exp']))
-                    correct_answer = dataset_row['cop']
+                question_uid = int(question_uid)
+                if cop_confidence_without_context < 0.26:
+                    if question_uid not in subgraph_uids_cache:
+                        subgraph_uids_cache[question_uid] = group_subgraph_tuples(question_to_subgraphs_mapping[question_uid], device=device)
+
+                    # Defer the context search, all questions of the batch are processed together below
+                    questions_needing_context.append((j, question_uid, cop_confidence_without_context, is_correct_without_context))
+
+                else:
+                    # Accumulate Results
+                    llm_aided_confidence.update(cop_confidence_without_context)
+                    llm_aided_accuracy.update(is_correct_without_context)
+                    vanilla_confidence.update(cop_confidence_without_context)
+                    vanilla_accuracy.update(is_correct_without_context)
+
+            # Find the most relevant nodes of all questions needing context at once
+            if len(questions_needing_context) > 0:
+                context_questions_positions = torch.tensor([j for j, _, _, _ in questions_needing_context], device=unseen_questions_embeddings.device)
+                most_relevant_nodes_lists = find_most_relevant_nodes(batch,
+                                                                     z_dict,
+                                                                     unseen_questions_embeddings[context_questions_positions],
+                                                                     [subgraph_uids_cache[question_uid] for _, question_uid, _, _ in questions_needing_context],
+                                                                     prime_kg,
+                                                                     k=2)
+
+                for (_, question_uid, cop_confidence_without_context, is_correct_without_context), most_relevant_nodes in zip(questions_needing_context, most_relevant_nodes_lists):
+                    question_dict = qa_records[question_uid]
+                    correct_answer = question_dict['cop']
                     prompt = """Context: {}. Question: {} A. {} B. {} C. {} D. {}""".format(
                         ",".join(most_relevant_nodes),
                         question_dict['question'],
@@ -300,55 +423,49 @@ def evaluate(llm, medical_hgt, split_loaders, split_name, device, qa_dataset, pr
                         question_dict['opc'],
                         question_dict['opd']
                     )
+                    questions_with_context.append((question_uid, correct_answer, prompt, cop_confidence_without_context, is_correct_without_context))
 
-                    # Process question with context
-                    output_encodings, predictions = llm.inference(prompt)
-                    llm_response_dict = llm.get_confidence(correct_answer_map[correct_answer], output_encodings, predictions)
+            # Batch process the questions with context
+            if len(questions_with_context) > 0:
+                prompts = [prompt for _, _, prompt, _, _ in questions_with_context]
+                batch_output_encodings, batch_predictions = llm.inference_batch(prompts)
+
+                for j, (question_uid, correct_answer, _, cop_confidence_without_context, is_correct_without_context) in enumerate(questions_with_context):
+                    llm_response_dict = llm.get_confidence(answer_letters[correct_answer], batch_output_encodings[j], batch_predictions[j])
                     if llm_response_dict['confidence'] == -1:
-                        print(f'Wrong response format. Question {i} ignored during eval')
+                        print(f'Wrong response format. Question {question_uid} ignored during eval')
                         continue
 
                     # Accumulate Results
-                    llm_aided_confidence_list.append(llm_response_dict['cop_confidence'])
-                    llm_aided_accuracy_list.append(llm_response_dict['accuracy'])
-                    vanilla_confidence_list.append(llm_feedback_without_context.cop_confidence_without_context)
-                    vanilla_accuracy_list.append(llm_feedback_without_context.is_correct_without_context)
-
-                else:
-                    # Accumulate Results
-                    llm_aided_confidence_list.append(llm_feedback_without_context.cop_confidence_without_context)
-                    llm_aided_accuracy_list.append(llm_feedback_without_context.is_correct_without_context)
-                    vanilla_confidence_list.append(llm_feedback_without_context.cop_confidence_without_context)
-                    vanilla_accuracy_list.append(llm_feedback_without_context.is_correct_without_context)
+                    llm_aided_confidence.update(llm_response_dict['cop_confidence'])
+                    llm_aided_accuracy.update(llm_response_dict['accuracy'])
+                    vanilla_confidence.update(cop_confidence_without_context)
+                    vanilla_accuracy.update(is_correct_without_context)
 
             # Calculate average performance of the batch
-            batch_average_vanilla_confidence = sum(vanilla_confidence_list) / max(1, len(vanilla_confidence_list))
-            batch_average_vanilla_accuracy = sum(vanilla_accuracy_list) / max(1, len(vanilla_accuracy_list))
-            batch_average_context_confidence = sum(llm_aided_confidence_list) / max(1, len(llm_aided_confidence_list))
-            batch_average_context_accuracy = sum(llm_aided_accuracy_list) / max(1, len(llm_aided_accuracy_list))
+            batch_average_vanilla_confidence = vanilla_confidence.mean()
+            batch_average_vanilla_accuracy = vanilla_accuracy.mean()
+            batch_average_context_confidence = llm_aided_confidence.mean()
+            batch_average_context_accuracy = llm_aided_accuracy.mean()
 
             if batch_average_context_confidence > 0:
-                average_llm_aided_confidence_list.append(batch_average_context_confidence)
-                average_llm_aided_accuracy_list.append(batch_average_context_accuracy)
-                average_llm_vanilla_confidence_list.append(batch_average_vanilla_confidence)
-                average_llm_vanilla_accuracy_list.append(batch_average_vanilla_accuracy)
+                average_llm_aided_confidence.update(batch_average_context_confidence)
+                average_llm_aided_accuracy.update(batch_average_context_accuracy)
+                average_llm_vanilla_confidence.update(batch_average_vanilla_confidence)
+                average_llm_vanilla_accuracy.update(batch_average_vanilla_accuracy)
 
         if batch_num >= num_batches:
             break
 
     medical_hgt.train()
 
-    pos_pred = torch.cat(pos_y_pred_tensors, dim=0).cpu().numpy()
-    neg_pred = torch.cat(neg_y_pred_tensors, dim=0).cpu().numpy()
-    pos_true = torch.cat(pos_y_true_tensors, dim=0).cpu().numpy()
-    neg_true = torch.cat(neg_y_true_tensors, dim=0).cpu().numpy()
-
-    pred = np.concatenate([pos_pred, neg_pred])
-    true = np.concatenate([pos_true, neg_true])
+    # Concatenate on the device, so that predictions and labels are each copied to the host once
+    pred = torch.cat(pos_y_pred_tensors + neg_y_pred_tensors, dim=0).cpu()
+    true = torch.cat(pos_y_true_tensors + neg_y_true_tensors, dim=0).long().cpu()
 
     llm_results = {
-        'vanilla_accuracy': sum(average_llm_vanilla_accuracy_list) / max(1, len(average_llm_vanilla_accuracy_list)),
-        'context_accuracy': sum(average_llm_aided_accuracy_list) / max(1, len(average_llm_aided_accuracy_list)),
+        'vanilla_accuracy': average_llm_vanilla_accuracy.mean(),
+        'context_accuracy': average_llm_aided_accuracy.mean(),
     }
 
     return pred, true, llm_results
@@ -29,6 +29,9 @@ relation_types = ["indication", "phenotype_protein", "phenotype_phenotype", "dis
 
 node_types = ['question', 'drug', 'disease', 'effect/phenotype', 'gene/protein', 'answer', 'anatomy']
 
+# MedMCQA's correct option (cop) index to the answer letter used in the LLM prompts
+answer_letters = ('A', 'B', 'C', 'D')
+
 metadata = (['question', 'drug', 'disease', 'effect/phenotype', 'gene/protein', 'answer', 'anatomy'],
             [('drug', 'indication', 'disease'),
              ('disease', 'rev_indication', 'drug'),